@@ -3,10 +3,11 @@
 功能：用户名、积分榜、管理员、认负、计时器、悔棋申请、暂停、总时间
 """
 
-import json
 import asyncio
+import hmac
 import time
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import orjson
+from fastapi import FastAPI, WebSocket
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
@@ -15,6 +16,8 @@ app = FastAPI()
 
 VALID_ANSWERS = {"20051218", "20210620"}
 ADMIN_PASSWORD = "230620"
+SEND_TIMEOUT = 5.0      # 观战者一帧迟迟发不出去（对端卡死）时断开，单位秒；玩家不限
+SPECTATOR_BACKLOG = 128  # 观战者积压这么多条未发消息就踢掉；玩家不限
 
 
 class VerifyRequest(BaseModel):
@@ -29,122 +32,263 @@ async def verify_answer(req: VerifyRequest):
     return {"success": False, "message": "回答错误，请重试"}
 
 
+def _encode(message):
+    """编码为 UTF-8 的 JSON bytes，按二进制帧发送（省掉文本帧的 UTF-8 校验）"""
+    return orjson.dumps(message)
+
+
 # ============================================================
 # 游戏核心
 # ============================================================
 
+# 棋盘下发时编码为 225 个字符的 "0"/"1"/"2" 串，逐行拼接
+_BOARD_DIGITS = bytes.maketrans(b"\x00\x01\x02", b"012")
+
+# place_stone 的常见结果是固定的，直接复用同一个字典（调用方只读，不要修改）
+_MOVE_OK = {"success": True, "winner": 0, "message": ""}
+_ERR_NOT_YOUR_TURN = {"success": False, "winner": 0, "message": "还没轮到你"}
+_ERR_OUT_OF_BOARD = {"success": False, "winner": 0, "message": "位置超出棋盘"}
+_ERR_OCCUPIED = {"success": False, "winner": 0, "message": "该位置已有棋子"}
+
+
+def _build_win_masks():
+    """为每个格子列出所有经过它的五连位掩码（下标 row*15+col）"""
+    masks = [[] for _ in range(225)]
+    for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        for r in range(15):
+            for c in range(15):
+                if not (0 <= r + 4 * dr < 15 and 0 <= c + 4 * dc < 15):
+                    continue
+                cells = [(r + k * dr, c + k * dc) for k in range(5)]
+                m = 0
+                for rr, cc in cells:
+                    m |= 1 << (rr * 16 + cc)
+                for rr, cc in cells:
+                    masks[rr * 15 + cc].append(m)
+    return tuple(tuple(ms) for ms in masks)
+
+
+# 位棋盘中格子 (row, col) 对应第 row*16+col 位
+_WIN_MASKS_AT = _build_win_masks()
+
+
+def _has_five(bits, idx):
+    """刚落在 idx 的棋子是否连成五子：只检查经过该格的 ≤20 个五连掩码"""
+    for m in _WIN_MASKS_AT[idx]:
+        if bits & m == m:
+            return True
+    return False
+
+
+_CELL_RC = tuple(divmod(i, 15) for i in range(225))
+
+
+def _unpack_moves(mh, start):
+    """把从第 start 步起的打包棋步还原成下发用的 [row, col, color] 列表"""
+    return [[*_CELL_RC[mh[i]], mh[i + 1]] for i in range(start * 2, len(mh), 2)]
+
+
 class GomokuGame:
     def __init__(self):
+        # 每次重置/悔棋 +1，之前的棋步记录即作废；起点取启动时间，
+        # 服务重启后客户端带来的旧 epoch 不会和新进程的撞上
+        self.epoch = int(time.time()) << 16
         self.reset()
 
     def reset(self):
-        self.board = [[0] * 15 for _ in range(15)]
+        self.epoch += 1
+        self.board = bytearray(225)     # 扁平棋盘，下标 row*15+col
+        self.bits = {1: 0, 2: 0}        # 各方位棋盘，用于判胜
         self.current_turn = 1
         self.winner = 0
-        self.move_history = []
+        self.move_history = bytearray()  # 每步 2 字节：row*15+col, color
         self.game_started = False
+        self._state_json = None         # get_state() 的编码缓存
+
+    @property
+    def game_started(self):
+        return self._game_started
+
+    @game_started.setter
+    def game_started(self, value):
+        self._game_started = value
+        self._state_json = None
 
     def place_stone(self, row, col, color):
         if color != self.current_turn:
-            return {"success": False, "winner": 0, "message": "还没轮到你"}
+            return _ERR_NOT_YOUR_TURN
         if self.winner != 0:
             return {"success": False, "winner": self.winner, "message": "游戏已结束"}
         if not (0 <= row < 15 and 0 <= col < 15):
-            return {"success": False, "winner": 0, "message": "位置超出棋盘"}
-        if self.board[row][col] != 0:
-            return {"success": False, "winner": 0, "message": "该位置已有棋子"}
-        self.board[row][col] = color
-        self.move_history.append((row, col, color))
-        if self._check_win(row, col, color):
+            return _ERR_OUT_OF_BOARD
+        board = self.board
+        idx = row * 15 + col
+        if board[idx] != 0:
+            return _ERR_OCCUPIED
+        board[idx] = color
+        bits = self.bits[color] | (1 << (row * 16 + col))
+        self.bits[color] = bits
+        self._state_json = None
+        mh = self.move_history
+        mh.extend((idx, color))
+        if _has_five(bits, idx):
             self.winner = color
             return {"success": True, "winner": color,
                     "message": f"{'黑' if color == 1 else '白'}方获胜！"}
-        if len(self.move_history) >= 225:
+        if len(mh) >= 225 * 2:
             return {"success": True, "winner": -1, "message": "平局！"}
         self.current_turn = 3 - color
-        return {"success": True, "winner": 0, "message": ""}
+        return _MOVE_OK
 
     def resign(self, color):
         if self.winner != 0:
             return False
         self.winner = 3 - color
+        self._state_json = None
         return True
 
     def timeout(self, color):
         if self.winner != 0:
             return False
         self.winner = 3 - color
+        self._state_json = None
         return True
 
     def undo(self):
         if not self.move_history:
             return False
-        row, col, color = self.move_history.pop()
-        self.board[row][col] = 0
+        mh = self.move_history
+        idx, color = mh[-2:]
+        del mh[-2:]
+        self.epoch += 1
+        self.board[idx] = 0
+        row, col = _CELL_RC[idx]
+        self.bits[color] &= ~(1 << (row * 16 + col))
+        self._state_json = None
         self.current_turn = color
         self.winner = 0
         return True
 
-    def _check_win(self, row, col, color):
-        for dr, dc in [(0, 1), (1, 0), (1, 1), (1, -1)]:
-            count = 1
-            r, c = row + dr, col + dc
-            while 0 <= r < 15 and 0 <= c < 15 and self.board[r][c] == color:
-                count += 1; r += dr; c += dc
-            r, c = row - dr, col - dc
-            while 0 <= r < 15 and 0 <= c < 15 and self.board[r][c] == color:
-                count += 1; r -= dr; c -= dc
-            if count >= 5:
-                return True
-        return False
-
     def get_state(self):
+        mh = self.move_history
         return {
-            "board": self.board,
+            "board": self.board.translate(_BOARD_DIGITS).decode(),
             "current_turn": self.current_turn,
             "winner": self.winner,
-            "move_history": self.move_history,
+            "move_history": _unpack_moves(mh, 0),
             "game_started": self.game_started,
+            "epoch": self.epoch,
         }
 
+    def get_patch(self, epoch, since):
+        """客户端已有本局（epoch）的前 since 步时，返回补齐所需的增量；不能续用则返回 None"""
+        mh = self.move_history
+        if epoch != self.epoch or not 0 <= since * 2 <= len(mh):
+            return None
+        return {
+            "from": since,
+            "moves": _unpack_moves(mh, since),
+            "current_turn": self.current_turn,
+            "winner": self.winner,
+            "game_started": self.game_started,
+        }
+
+    def get_state_json(self):
+        """get_state() 的 JSON 编码，棋局有变化时才重新编码"""
+        if self._state_json is None:
+            self._state_json = _encode(self.get_state())
+        return self._state_json
+
 
 # ============================================================
 # 连接管理
 # ============================================================
 
+# 按颜色分配的身份（0 为观战者）
+_ROLE_INFO = {
+    1: {"role": "black", "color": 1, "message": "你是黑方（先手）"},
+    2: {"role": "white", "color": 2, "message": "你是白方（后手）"},
+    0: {"role": "spectator", "color": 0, "message": "你正在观战"},
+}
+_ROLE_FRAMES = {c: _encode({"type": "role_assigned", **info}) for c, info in _ROLE_INFO.items()}
+
+# 内容固定的消息，启动时编码一次
+_STATIC = {
+    "role_demoted": _encode({"type": "role_assigned", "role": "spectator", "color": 0,
+                             "message": "你现在是观战者"}),
+    "game_start": _encode({"type": "game_start", "message": "双方已就位，游戏开始！黑方先手。"}),
+    "undo_sent": _encode({"type": "admin_message", "message": "已发送悔棋请求，等待回应..."}),
+    "err_already_paused": _encode({"type": "error", "message": "已在暂停中"}),
+    "err_no_pauses": _encode({"type": "error", "message": "你的暂停次数已用完"}),
+    "err_spectator_move": _encode({"type": "error", "message": "观战者不能落子"}),
+    "err_waiting": _encode({"type": "error", "message": "等待对手加入..."}),
+    "err_paused": _encode({"type": "error", "message": "比赛暂停中"}),
+    "err_no_undo": _encode({"type": "error", "message": "没有可以悔的棋"}),
+    "err_bad_message": _encode({"type": "error", "message": "消息格式错误"}),
+    "err_admin_password": _encode({"type": "error", "message": "管理员密码错误"}),
+}
+
+# 落子广播最频繁，直接按模板拼 bytes，message 单独编码以保证转义
+_MOVE_FRAME = (b'{"type":"move","row":%d,"col":%d,"color":%d,'
+               b'"current_turn":%d,"winner":%d,"message":%s}')
+
+
+async def _close_quietly(websocket):
+    """以 1013（稍后再试）关闭连接，连接已断时忽略"""
+    try:
+        await websocket.close(code=1013)
+    except Exception:
+        pass
+
+
 class ConnectionManager:
     def __init__(self):
         self.game = GomokuGame()
         self.players = {}
-        self.spectators = []
+        self.ws_to_color = {}           # players 的反向索引
+        self.spectators = {}            # 有序 dict 当集合用，保留加入顺序
         self.usernames = {}
         self.scoreboard = {}
+        self._scores_json = None        # 排序后的积分榜 JSON 缓存，写入即失效
         self.max_capacity = 3
-        self.lock = asyncio.Lock()
 
         # --- 计时系统 ---
         self.turn_time_limit = 20       # 每步时限（0=不限）
         self.total_time_setting = 300   # 总时间设置（秒），默认5分钟（0=不限）
         self.total_time = {1: 300, 2: 300}  # 各方剩余总时间
-        self.turn_remaining = 0         # 当前步剩余秒数
-        self.timer_task = None
+        self.turn_remaining = 0         # 当前步剩余秒数（计时中为开表时的值）
+        self._timer_handle = None       # 最近一次到期的 call_at 句柄
+        self._clock_start = None        # 本步开表的 loop.time()，None 表示没在计时
+        self._clock_color = 0           # 正在计时的一方
+        self._timer_key = None          # timer_sync 编码缓存对应的计时状态
+        self._timer_cache = None
 
         # --- 暂停系统 ---
         self.paused = False
         self.pause_by = 0               # 谁发起的暂停（颜色）
-        self.pause_remaining = 0        # 暂停剩余秒数
+        self.pause_remaining = 0        # 暂停剩余秒数（暂停开始时的值）
         self.pause_counts = {1: 2, 2: 2}  # 各方剩余暂停次数
         self.pause_duration = 300       # 每次暂停时长（秒），默认5分钟
-        self.pause_timer_task = None
+        self.pause_timer_task = None    # 暂停到期后的恢复任务
+        self._pause_handle = None       # 暂停到期的 call_at 句柄
+        self._pause_start = None        # 本次暂停开始的 loop.time()
 
         # --- 悔棋 ---
         self.pending_undo_from = None
 
+        # --- 发送队列 ---
+        self.queues = {}                # 每个连接的待发送消息（已编码）
+        self.relays = {}                # 每个连接的发送任务
+        self._presence_flush = None     # 已排期的在线状态广播
+        self._closing = set()           # 正在关闭的连接任务，保留引用以免被回收
+
     def _get_total_count(self):
         return len(self.players) + len(self.spectators)
 
     def reset_timers(self):
         """重置所有计时器状态"""
+        self._stop_clock(settle=False)
+        self._cancel_pause_clock()
         self.total_time = {1: self.total_time_setting, 2: self.total_time_setting}
         self.turn_remaining = self.turn_time_limit
         self.paused = False
@@ -154,85 +298,118 @@ class ConnectionManager:
         self.pending_undo_from = None
 
     # =============== 主计时器 ===============
+    # 不再每秒 tick：开表时记下起点，用 call_at 在最先到期的时刻触发超时；
+    # 剩余时间随时由起点推算，只在状态变化时广播，客户端自行倒数
 
-    async def start_timer(self):
-        await self.cancel_timer()
+    def start_timer(self):
+        self.cancel_timer()
         if self.game.winner != 0 or not self.game.game_started or self.paused:
             return
         self.turn_remaining = self.turn_time_limit
-        self.timer_task = asyncio.create_task(self._timer_loop())
-
-    async def cancel_timer(self):
-        if self.timer_task and not self.timer_task.done():
-            self.timer_task.cancel()
-            try:
-                await self.timer_task
-            except asyncio.CancelledError:
-                pass
-        self.timer_task = None
-
-    async def _timer_loop(self):
-        """每秒 tick：递减步时 + 总时间"""
-        try:
-            await self._broadcast_timer()
-            while True:
-                await asyncio.sleep(1)
-                color = self.game.current_turn
-
-                # 递减步时
-                if self.turn_time_limit > 0:
-                    self.turn_remaining -= 1
-                    if self.turn_remaining <= 0:
-                        await self._handle_timeout(color, "turn")
-                        return
-
-                # 递减总时间
-                if self.total_time_setting > 0:
-                    self.total_time[color] -= 1
-                    if self.total_time[color] <= 0:
-                        self.total_time[color] = 0
-                        await self._handle_timeout(color, "total")
-                        return
-
-                await self._broadcast_timer()
-
-        except asyncio.CancelledError:
-            pass
-
-    async def _handle_timeout(self, color, reason):
-        """处理超时"""
-        if self.game.timeout(color):
-            loser_name = self.usernames.get(self.players.get(color), "???")
-            winner_color = 3 - color
-            winner_ws = self.players.get(winner_color)
-            if winner_ws:
-                wn = self.usernames.get(winner_ws, "???")
-                self.scoreboard[wn] = self.scoreboard.get(wn, 0) + 1
-
-            reason_text = "步时超时" if reason == "turn" else "总时间耗尽"
-            await self.broadcast({
+        self._run_clock()
+        self._broadcast_timer()
+
+    def cancel_timer(self):
+        self._stop_clock()
+
+    def _run_clock(self):
+        """从当前剩余时间开始为走棋方计时"""
+        loop = asyncio.get_running_loop()
+        color = self.game.current_turn
+        self._clock_color = color
+        self._clock_start = loop.time()
+        deadlines = []
+        if self.turn_time_limit > 0:
+            deadlines.append((self.turn_remaining, "turn"))
+        if self.total_time_setting > 0:
+            deadlines.append((self.total_time[color], "total"))
+        if deadlines:
+            delay, reason = min(deadlines, key=lambda d: d[0])
+            self._timer_handle = loop.call_at(self._clock_start + delay,
+                                              self._on_deadline, color, reason)
+
+    def _stop_clock(self, settle=True):
+        """停表；settle 时把本步已用时间扣到步时和走棋方总时间上"""
+        if self._timer_handle:
+            self._timer_handle.cancel()
+            self._timer_handle = None
+        if self._clock_start is None:
+            return
+        if settle:
+            self.turn_remaining, self.total_time = self._clock_values()
+        self._clock_start = None
+
+    def _clock_values(self):
+        """当前步剩余秒数与双方剩余总时间（计时中则扣掉本步已用时间）"""
+        turn, total = self.turn_remaining, dict(self.total_time)
+        if self._clock_start is not None:
+            elapsed = asyncio.get_running_loop().time() - self._clock_start
+            turn = max(0, turn - elapsed)
+            if self.total_time_setting > 0:
+                c = self._clock_color
+                total[c] = max(0, total[c] - elapsed)
+        return turn, total
+
+    def _on_deadline(self, color, reason):
+        self._timer_handle = None
+        self._stop_clock()
+        if reason == "turn":
+            self.turn_remaining = 0
+        else:
+            self.total_time[color] = 0
+        # 判负、记分和广播都在回调里同步完成（广播只是入队），不留给下一轮的任务：
+        # 否则中间到达的落子或重置会和这次超时交错
+        if not self.game.timeout(color):
+            return
+        loser_name = self.usernames.get(self.players.get(color), "???")
+        winner_color = 3 - color
+        self._credit_win(winner_color)
+        reason_text = "步时超时" if reason == "turn" else "总时间耗尽"
+        if self.queues:
+            self._fanout(_encode({
                 "type": "game_over",
                 "winner": winner_color,
                 "reason": reason,
                 "message": f"{loser_name} {reason_text}，{'黑' if winner_color == 1 else '白'}方获胜！",
-            })
-            await self._broadcast_timer()
-            await self.broadcast_scoreboard()
+            }))
+            self._broadcast_timer()
+            self._fanout(self._scoreboard_payload())
 
-    async def _broadcast_timer(self):
+    def _broadcast_timer(self):
         """广播完整计时状态"""
-        await self.broadcast({
-            "type": "timer_sync",
-            "turn_remaining": self.turn_remaining if self.turn_time_limit > 0 else -1,
-            "turn_total": self.turn_time_limit,
-            "total_time": {str(k): v for k, v in self.total_time.items()},
-            "total_time_setting": self.total_time_setting,
-            "current_turn": self.game.current_turn,
-            "paused": self.paused,
-            "pause_by": self.pause_by,
-            "pause_remaining": self.pause_remaining,
-            "pause_counts": {str(k): v for k, v in self.pause_counts.items()},
-        })
+        if self.queues:
+            self._fanout(self._timer_payload())
+
+    def _timer_payload(self):
+        """timer_sync 的编码结果，计时状态没变时直接复用上一次的
+
+        running 为真时客户端从收到的时刻起自行倒数 turn_remaining 和走棋方的总时间，
+        paused 为真时同样自行倒数 pause_remaining。
+        """
+        turn, total = self._clock_values()
+        turn, t1, t2 = round(turn, 1), round(total[1], 1), round(total[2], 1)
+        pause_left = round(self._pause_left(), 1)
+        running = self._clock_start is not None
+        p1, p2 = self.pause_counts[1], self.pause_counts[2]
+        key = (turn, self.turn_time_limit, t1, t2, self.total_time_setting,
+               self.game.current_turn, running, self.paused, self.pause_by,
+               pause_left, p1, p2)
+        if key != self._timer_key:
+            self._timer_key = key
+            self._timer_cache = _encode({
+                "type": "timer_sync",
+                "turn_remaining": turn if self.turn_time_limit > 0 else -1,
+                "turn_total": self.turn_time_limit,
+                "total_time": {"1": t1, "2": t2},
+                "total_time_setting": self.total_time_setting,
+                "current_turn": self.game.current_turn,
+                "running": running,
+                "paused": self.paused,
+                "pause_by": self.pause_by,
+                "pause_remaining": pause_left,
+                "pause_counts": {"1": p1, "2": p2},
+            })
+        return self._timer_cache
 
     # =============== 暂停系统 ===============
 
@@ -242,10 +419,10 @@ class ConnectionManager:
         if color is None or not self.game.game_started or self.game.winner != 0:
             return
         if self.paused:
-            await websocket.send_json({"type": "error", "message": "已在暂停中"})
+            self._push(websocket, _STATIC["err_already_paused"])
             return
         if self.pause_counts.get(color, 0) <= 0:
-            await websocket.send_json({"type": "error", "message": "你的暂停次数已用完"})
+            self._push(websocket, _STATIC["err_no_pauses"])
             return
 
         self.pause_counts[color] -= 1
@@ -254,7 +431,7 @@ class ConnectionManager:
         self.pause_remaining = self.pause_duration
 
         # 停掉主计时器
-        await self.cancel_timer()
+        self.cancel_timer()
 
         pname = self.usernames.get(websocket, "???")
         await self.broadcast({
@@ -262,9 +439,12 @@ class ConnectionManager:
             "message": f"⏸ {pname} 申请暂停（剩余{self.pause_counts[color]}次）",
         })
 
-        # 启动暂停倒计时
-        self.pause_timer_task = asyncio.create_task(self._pause_countdown())
-        await self._broadcast_timer()
+        # 暂停到期时自动恢复；剩余时间按起点推算，不靠每秒递减
+        loop = asyncio.get_running_loop()
+        self._pause_start = loop.time()
+        self._pause_handle = loop.call_at(self._pause_start + self.pause_duration,
+                                          self._on_pause_expired)
+        self._broadcast_timer()
 
     async def handle_unpause(self, websocket):
         """任一棋手取消暂停"""
@@ -284,110 +464,123 @@ class ConnectionManager:
         self.paused = False
         self.pause_by = 0
         self.pause_remaining = 0
+        self._cancel_pause_clock()
 
-        # 取消暂停倒计时
-        if self.pause_timer_task and not self.pause_timer_task.done():
-            self.pause_timer_task.cancel()
-            try:
-                await self.pause_timer_task
-            except asyncio.CancelledError:
-                pass
-        self.pause_timer_task = None
-
-        await self._broadcast_timer()
+        self._broadcast_timer()
 
         # 恢复主计时器
         if self.game.game_started and self.game.winner == 0:
-            await self.start_timer()
-
-    async def _pause_countdown(self):
-        """暂停倒计时，到 0 自动恢复"""
-        try:
-            while self.pause_remaining > 0:
-                await asyncio.sleep(1)
-                self.pause_remaining -= 1
-                await self._broadcast_timer()
-
-            # 暂停时间到，自动恢复
-            if self.paused:
-                await self.broadcast({
-                    "type": "admin_message",
-                    "message": "⏸ 暂停时间到，比赛继续",
-                })
-                await self._do_unpause()
-
-        except asyncio.CancelledError:
-            pass
+            self.start_timer()
+
+    def _cancel_pause_clock(self):
+        if self._pause_handle:
+            self._pause_handle.cancel()
+            self._pause_handle = None
+        self._pause_start = None
+
+    def _pause_left(self):
+        """暂停剩余秒数"""
+        if self._pause_start is None:
+            return self.pause_remaining
+        elapsed = asyncio.get_running_loop().time() - self._pause_start
+        return max(0, self.pause_remaining - elapsed)
+
+    def _on_pause_expired(self):
+        self._pause_handle = None
+        self.pause_timer_task = asyncio.create_task(self._pause_expired())
+
+    async def _pause_expired(self):
+        """暂停时间到，自动恢复"""
+        if self.paused:
+            await self.broadcast({
+                "type": "admin_message",
+                "message": "⏸ 暂停时间到，比赛继续",
+            })
+            await self._do_unpause()
 
     # =============== 连接管理 ===============
 
     def _get_color(self, websocket):
-        for c, ws in self.players.items():
-            if ws == websocket:
-                return c
-        return None
+        return self.ws_to_color.get(websocket)
 
     async def connect(self, websocket: WebSocket) -> dict:
+        # 事件循环是单线程的：下面的判断和登记之间没有 await，本身就是原子的，无需加锁
         await websocket.accept()
-        async with self.lock:
-            if self._get_total_count() >= self.max_capacity:
-                return {"role": "rejected", "color": 0, "message": "房间已满"}
-            if 1 not in self.players:
-                self.players[1] = websocket
-                role = {"role": "black", "color": 1, "message": "你是黑方（先手）"}
-                if 2 in self.players:
-                    self.game.game_started = True
-                return role
-            elif 2 not in self.players:
-                self.players[2] = websocket
-                role = {"role": "white", "color": 2, "message": "你是白方（后手）"}
+        if self._get_total_count() >= self.max_capacity:
+            return {"role": "rejected", "color": 0, "message": "房间已满"}
+        self._open_queue(websocket)
+        if 1 not in self.players:
+            self.players[1] = websocket
+            self.ws_to_color[websocket] = 1
+            if 2 in self.players:
                 self.game.game_started = True
-                await self._notify_game_start()
-                return role
-            else:
-                self.spectators.append(websocket)
-                return {"role": "spectator", "color": 0, "message": "你正在观战"}
+            return _ROLE_INFO[1]
+        elif 2 not in self.players:
+            self.players[2] = websocket
+            self.ws_to_color[websocket] = 2
+            self.game.game_started = True
+            await self._notify_game_start()
+            return _ROLE_INFO[2]
+        else:
+            self.spectators[websocket] = None
+            return _ROLE_INFO[0]
 
     async def disconnect(self, websocket: WebSocket):
-        async with self.lock:
-            for color, ws in list(self.players.items()):
-                if ws == websocket:
-                    del self.players[color]
-                    uname = self.usernames.get(websocket, "???")
-                    name = "黑方" if color == 1 else "白方"
-                    await self.broadcast({
-                        "type": "player_left",
-                        "message": f"{name}（{uname}）已断开连接",
-                        "color": color,
-                    })
-                    self.game.game_started = False
-                    await self.cancel_timer()
-                    if self.paused:
-                        await self._do_unpause()
-                    self.pending_undo_from = None
-                    break
-            else:
-                if websocket in self.spectators:
-                    self.spectators.remove(websocket)
-            self.usernames.pop(websocket, None)
+        # 先同步地改完连接表，再 await 广播和计时器
+        self._close_queue(websocket)
+        uname = self.usernames.pop(websocket, "???")
+        color = self.ws_to_color.pop(websocket, None)
+        if color is None:
+            self.spectators.pop(websocket, None)
+            return
+
+        del self.players[color]
+        self.game.game_started = False
+        self.pending_undo_from = None
+        name = "黑方" if color == 1 else "白方"
+        await self.broadcast({
+            "type": "player_left",
+            "message": f"{name}（{uname}）已断开连接",
+            "color": color,
+        })
+        self.cancel_timer()
+        self._broadcast_timer()
+        if self.paused:
+            await self._do_unpause()
 
-    def set_username(self, websocket, username):
+    async def handle_set_username(self, websocket, username):
         self.usernames[websocket] = username
         if username not in self.scoreboard:
             self.scoreboard[username] = 0
+            self._scores_json = None
+        self.mark_presence_dirty()
+        # 双方到齐且还没落子时（重新）开始计时
+        if (self.game.game_started and self.game.winner == 0
+                and not self.game.move_history
+                and len(self.players) == 2
+                and not self.paused):
+            self.start_timer()
+
+    def _credit_win(self, color):
+        """给胜方记一分"""
+        winner_ws = self.players.get(color)
+        if winner_ws:
+            wn = self.usernames.get(winner_ws, "???")
+            self.scoreboard[wn] = self.scoreboard.get(wn, 0) + 1
+            self._scores_json = None
 
     # =============== 落子 ===============
 
     async def handle_move(self, websocket, row, col):
         color = self._get_color(websocket)
         if color is None:
-            await websocket.send_json({"type": "error", "message": "观战者不能落子"})
+            self._push(websocket, _STATIC["err_spectator_move"])
             return
         if not self.game.game_started:
-            await websocket.send_json({"type": "error", "message": "等待对手加入..."})
+            self._push(websocket, _STATIC["err_waiting"])
             return
         if self.paused:
-            await websocket.send_json({"type": "error", "message": "比赛暂停中"})
+            self._push(websocket, _STATIC["err_paused"])
             return
 
         self.pending_undo_from = None
@@ -395,25 +588,19 @@ class ConnectionManager:
 
         if result["success"]:
             if result["winner"] > 0:
-                winner_ws = self.players.get(result["winner"])
-                if winner_ws:
-                    wn = self.usernames.get(winner_ws, "???")
-                    self.scoreboard[wn] = self.scoreboard.get(wn, 0) + 1
-                await self.cancel_timer()
+                self._credit_win(result["winner"])
+                self.cancel_timer()
 
-            await self.broadcast({
-                "type": "move", "row": row, "col": col, "color": color,
-                "current_turn": self.game.current_turn,
-                "winner": result["winner"], "message": result["message"],
-            })
+            self._fanout(_MOVE_FRAME % (row, col, color, self.game.current_turn,
+                                        result["winner"], _encode(result["message"])))
 
             if result["winner"] != 0:
                 await self.broadcast_scoreboard()
-                await self._broadcast_timer()
+                self._broadcast_timer()
             elif self.game.game_started:
-                await self.start_timer()
+                self.start_timer()
         else:
-            await websocket.send_json({"type": "error", "message": result["message"]})
+            await self.send(websocket, {"type": "error", "message": result["message"]})
 
     # =============== 认负 ===============
 
@@ -422,20 +609,17 @@ class ConnectionManager:
         if color is None or not self.game.game_started:
             return
         if self.game.resign(color):
-            await self.cancel_timer()
+            self.cancel_timer()
             if self.paused:
                 await self._do_unpause()
             winner_color = 3 - color
             loser_name = self.usernames.get(websocket, "???")
-            winner_ws = self.players.get(winner_color)
-            if winner_ws:
-                wn = self.usernames.get(winner_ws, "???")
-                self.scoreboard[wn] = self.scoreboard.get(wn, 0) + 1
+            self._credit_win(winner_color)
             await self.broadcast({
                 "type": "game_over", "winner": winner_color, "reason": "resign",
                 "message": f"{loser_name} 投子认负，{'黑' if winner_color == 1 else '白'}方获胜！",
             })
-            await self._broadcast_timer()
+            self._broadcast_timer()
             await self.broadcast_scoreboard()
 
     # =============== 申请悔棋 ===============
@@ -445,25 +629,23 @@ class ConnectionManager:
         if color is None or not self.game.game_started or self.game.winner != 0:
             return
         if not self.game.move_history:
-            await websocket.send_json({"type": "error", "message": "没有可以悔的棋"})
+            self._push(websocket, _STATIC["err_no_undo"])
             return
 
         self.pending_undo_from = color
         rname = self.usernames.get(websocket, "???")
-        await self.cancel_timer()
+        self.cancel_timer()
+        self._broadcast_timer()
 
         opp = self.players.get(3 - color)
         if opp:
-            await opp.send_json({
+            await self.send(opp, {
                 "type": "undo_request", "from_color": color,
                 "from_name": rname, "message": f"{rname} 请求悔棋，是否同意？",
             })
-        await websocket.send_json({"type": "admin_message", "message": "已发送悔棋请求，等待回应..."})
-        for ws in self.spectators:
-            try:
-                await ws.send_json({"type": "admin_message", "message": f"{rname} 请求悔棋..."})
-            except:
-                pass
+        self._push(websocket, _STATIC["undo_sent"])
+        await self.broadcast({"type": "admin_message", "message": f"{rname} 请求悔棋..."},
+                             exclude=self.ws_to_color)
 
     async def handle_undo_response(self, websocket, accepted):
         if self.pending_undo_from is None:
@@ -475,35 +657,33 @@ class ConnectionManager:
 
         if accepted:
             if self.game.undo():
-                state = self.game.get_state()
-                await self.broadcast({"type": "sync_state", **state, "message": "对手同意了悔棋"})
+                self._fanout(self._sync_state_payload("对手同意了悔棋"))
                 await self.broadcast({"type": "admin_message", "message": "悔棋成功"})
                 if self.game.game_started and self.game.winner == 0 and not self.paused:
-                    await self.start_timer()
+                    self.start_timer()
         else:
             rname = self.usernames.get(websocket, "???")
             await self.broadcast({"type": "admin_message", "message": f"{rname} 拒绝了悔棋请求"})
             if self.game.game_started and self.game.winner == 0 and not self.paused:
-                await self.start_timer()
+                self.start_timer()
 
     # =============== 重置 ===============
 
     async def handle_reset(self, websocket):
-        is_player = any(ws == websocket for ws in self.players.values())
-        if not is_player:
+        if websocket not in self.ws_to_color:
             return
         self.game.reset()
         self.reset_timers()
         if len(self.players) == 2:
             self.game.game_started = True
-        await self.cancel_timer()
+        self.cancel_timer()
         await self.broadcast({
             "type": "reset", "message": "棋局已重置",
             "game_started": self.game.game_started,
         })
-        await self._broadcast_timer()
+        self._broadcast_timer()
         if self.game.game_started:
-            await self.start_timer()
+            self.start_timer()
 
     # =============== 管理员 ===============
 
@@ -515,6 +695,7 @@ class ConnectionManager:
             self.players[2] = p1; del self.players[1]
         elif p2:
             self.players[1] = p2; del self.players[2]
+        self.ws_to_color = {ws: c for c, ws in self.players.items()}
 
         self.game.reset()
         self.reset_timers()
@@ -522,35 +703,29 @@ class ConnectionManager:
             self.game.game_started = True
 
         for color, ws in self.players.items():
-            role = "black" if color == 1 else "white"
-            await ws.send_json({
-                "type": "role_assigned", "role": role, "color": color,
-                "message": f"你是{'黑方（先手）' if color == 1 else '白方（后手）'}",
-            })
+            self._push(ws, _ROLE_FRAMES[color])
         for ws in self.spectators:
-            await ws.send_json({
-                "type": "role_assigned", "role": "spectator", "color": 0,
-                "message": "你正在观战",
-            })
+            self._push(ws, _ROLE_FRAMES[0])
 
-        await self.cancel_timer()
+        self.cancel_timer()
         await self.broadcast({
             "type": "reset", "message": "管理员交换了黑白方，棋局已重置",
             "game_started": self.game.game_started,
         })
         await self.broadcast_player_info()
-        await self._broadcast_timer()
+        self._broadcast_timer()
         if self.game.game_started:
-            await self.start_timer()
+            self.start_timer()
 
     async def admin_undo(self):
         if self.game.undo():
-            await self.cancel_timer()
-            state = self.game.get_state()
-            await self.broadcast({"type": "sync_state", **state, "message": "管理员执行了悔棋"})
+            self.cancel_timer()
+            self._fanout(self._sync_state_payload("管理员执行了悔棋"))
             await self.broadcast({"type": "admin_message", "message": "管理员执行了悔棋"})
             if self.game.game_started and self.game.winner == 0 and not self.paused:
-                await self.start_timer()
+                self.start_timer()
+            else:
+                self._broadcast_timer()
 
     async def admin_change_capacity(self, new_cap):
         self.max_capacity = max(2, new_cap)
@@ -565,18 +740,22 @@ class ConnectionManager:
                               "turn_time_limit": self.turn_time_limit,
                               "total_time_setting": self.total_time_setting})
         if self.game.game_started and self.game.winner == 0 and not self.paused:
-            await self.start_timer()
+            self.start_timer()
 
     async def admin_change_total_time(self, seconds):
         """更改总时间设置（同时重置双方剩余总时间）"""
+        running = self._clock_start is not None
+        self.cancel_timer()
         self.total_time_setting = max(0, seconds)
         self.total_time = {1: self.total_time_setting, 2: self.total_time_setting}
+        if running:
+            self._run_clock()
         label = f"{self.total_time_setting // 60}分{self.total_time_setting % 60}秒" if self.total_time_setting > 0 else "无限制"
         await self.broadcast({"type": "admin_message", "message": f"总时间已更改为 {label}（双方已重置）"})
         await self.broadcast({"type": "timer_setting",
                               "turn_time_limit": self.turn_time_limit,
                               "total_time_setting": self.total_time_setting})
-        await self._broadcast_timer()
+        self._broadcast_timer()
 
     async def admin_change_pause_duration(self, seconds):
         self.pause_duration = max(30, seconds)
@@ -584,9 +763,8 @@ class ConnectionManager:
         await self.broadcast({"type": "admin_message", "message": f"暂停时长已更改为 {label}"})
 
     async def admin_clear_scores(self):
-        self.scoreboard = {}
-        for ws, uname in self.usernames.items():
-            self.scoreboard[uname] = 0
+        self.scoreboard = dict.fromkeys(self.usernames.values(), 0)
+        self._scores_json = None
         await self.broadcast_scoreboard()
         await self.broadcast({"type": "admin_message", "message": "积分已清空"})
 
@@ -595,61 +773,156 @@ class ConnectionManager:
             return
         if player_color not in self.players:
             return
-        spec_ws = self.spectators[spectator_index]
+        specs = list(self.spectators)
+        spec_ws = specs[spectator_index]
         player_ws = self.players[player_color]
         self.players[player_color] = spec_ws
-        self.spectators[spectator_index] = player_ws
+        specs[spectator_index] = player_ws       # 换下来的玩家占原观战者的位置
+        self.spectators = dict.fromkeys(specs)
+        del self.ws_to_color[player_ws]
+        self.ws_to_color[spec_ws] = player_color
 
-        role = "black" if player_color == 1 else "white"
-        await spec_ws.send_json({
-            "type": "role_assigned", "role": role, "color": player_color,
-            "message": f"你是{'黑方（先手）' if player_color == 1 else '白方（后手）'}",
-        })
-        await player_ws.send_json({
-            "type": "role_assigned", "role": "spectator", "color": 0,
-            "message": "你现在是观战者",
-        })
+        self._push(spec_ws, _ROLE_FRAMES[player_color])
+        self._push(player_ws, _STATIC["role_demoted"])
 
         self.game.reset()
         self.reset_timers()
         if len(self.players) == 2:
             self.game.game_started = True
-        await self.cancel_timer()
+        self.cancel_timer()
         await self.broadcast({
             "type": "reset", "message": "管理员交换了棋手和观战者，棋局已重置",
             "game_started": self.game.game_started,
         })
         await self.broadcast_player_info()
-        await self._broadcast_timer()
+        self._broadcast_timer()
         if self.game.game_started:
-            await self.start_timer()
+            self.start_timer()
 
     # =============== 广播工具 ===============
 
-    async def broadcast(self, message):
-        dead = []
-        for color, ws in list(self.players.items()):
-            try:
-                await ws.send_json(message)
-            except:
-                pass
-        for ws in self.spectators:
-            try:
-                await ws.send_json(message)
-            except:
-                dead.append(ws)
-        for ws in dead:
-            self.spectators.remove(ws)
+    async def broadcast(self, message, exclude=()):
+        """同一条消息只编码一次，放进每个连接（exclude 中的除外）的发送队列"""
+        if self.queues:                 # 房间没人时连编码都省掉
+            self._fanout(_encode(message), exclude)
+
+    async def send(self, websocket, message):
+        """单独发给某个连接（与广播共用队列，保证先后顺序）"""
+        self._push(websocket, _encode(message))
+
+    def send_init(self, websocket, role_info, epoch=0, since=0):
+        """新连接的初始快照：棋局、积分、计时都复用缓存好的 JSON，
+        同步压进队列，由 relay 合成一帧发出"""
+        push = self._push
+        push(websocket, _ROLE_FRAMES[role_info["color"]])
+        patch = self.game.get_patch(epoch, since)
+        if patch is None:
+            push(websocket, self._sync_state_payload())
+        else:
+            push(websocket, _encode({"type": "patch", **patch}))
+        push(websocket, _encode({"type": "online_count", **self.get_online_count()}))
+        push(websocket, self._scoreboard_payload())
+        push(websocket, _encode({
+            "type": "room_info",
+            "max_capacity": self.max_capacity,
+            "current_count": self._get_total_count(),
+        }))
+        push(websocket, _encode({
+            "type": "timer_setting",
+            "turn_time_limit": self.turn_time_limit,
+            "total_time_setting": self.total_time_setting,
+        }))
+        push(websocket, self._timer_payload())
+
+    def _fanout(self, payload, exclude=()):
+        slow = None
+        for ws, q in self.queues.items():
+            if ws in exclude:
+                continue
+            if q.qsize() >= SPECTATOR_BACKLOG and ws not in self.ws_to_color:
+                slow = slow or []
+                slow.append(ws)
+                continue
+            q.put_nowait(payload)
+        if slow:
+            for ws in slow:
+                self._evict(ws)
+
+    def _evict(self, websocket):
+        """丢掉跟不上的连接：停掉发送并关闭，名单由 disconnect 清理"""
+        self._close_queue(websocket)
+        task = asyncio.get_running_loop().create_task(_close_quietly(websocket))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _push(self, websocket, payload):
+        q = self.queues.get(websocket)
+        if q:
+            q.put_nowait(payload)
+
+    def _sync_state_payload(self, message=None):
+        """在缓存的棋局 JSON 前拼上 type（和提示），避免重新编码棋盘"""
+        head = b'{"type":"sync_state",'
+        if message:
+            head += b'"message":' + _encode(message) + b","
+        return head + self.game.get_state_json()[1:]
+
+    def _open_queue(self, websocket):
+        q = asyncio.Queue()
+        self.queues[websocket] = q
+        self.relays[websocket] = asyncio.create_task(self._relay(websocket, q))
+
+    def _close_queue(self, websocket):
+        self.queues.pop(websocket, None)
+        task = self.relays.pop(websocket, None)
+        if task:
+            task.cancel()
+
+    async def _relay(self, websocket, q):
+        """取出队列中已积压的全部消息，合并成一帧发出"""
+        try:
+            while True:
+                batch = [await q.get()]
+                while not q.empty():
+                    batch.append(q.get_nowait())
+                if len(batch) == 1:
+                    frame = batch[0]
+                else:
+                    frame = b'{"type":"batch","items":[' + b",".join(batch) + b"]}"
+                # 和积压上限一样只对观战者生效：玩家被断开就等于结束对局
+                timeout = None if websocket in self.ws_to_color else SEND_TIMEOUT
+                await asyncio.wait_for(websocket.send_bytes(frame), timeout)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # 连接已断或卡死：先摘掉队列，后续广播直接跳过它，其余交给 disconnect 清理
+            if self.queues.get(websocket) is q:
+                del self.queues[websocket]
+                self.relays.pop(websocket, None)
+            if isinstance(e, asyncio.TimeoutError):
+                await _close_quietly(websocket)
+
+    def _scores_list_json(self):
+        """排序并编码积分榜，积分不变时直接复用"""
+        if self._scores_json is None:
+            self._scores_json = _encode(sorted(self.scoreboard.items(), key=lambda x: -x[1]))
+        return self._scores_json
+
+    def _scoreboard_payload(self):
+        return b'{"type":"scoreboard","scores":' + self._scores_list_json() + b"}"
 
     async def broadcast_scoreboard(self):
-        ss = sorted(self.scoreboard.items(), key=lambda x: -x[1])
-        await self.broadcast({"type": "scoreboard", "scores": ss})
+        self._fanout(self._scoreboard_payload())
+
+    def _roster(self):
+        """玩家和观众名单，player_info 与 presence 共用"""
+        names = self.usernames
+        pi = {str(c): names.get(ws, "???") for c, ws in self.players.items()}
+        si = [{"index": i, "name": names.get(ws, "???")} for i, ws in enumerate(self.spectators)]
+        return pi, si
 
     async def broadcast_player_info(self):
-        pi = {}
-        for color, ws in self.players.items():
-            pi[color] = self.usernames.get(ws, "???")
-        si = [{"index": i, "name": self.usernames.get(ws, "???")} for i, ws in enumerate(self.spectators)]
+        pi, si = self._roster()
         await self.broadcast({"type": "player_info", "players": pi, "spectators": si})
 
     async def broadcast_room_info(self):
@@ -660,14 +933,26 @@ class ConnectionManager:
         })
 
     async def _notify_game_start(self):
-        await self.broadcast({
-            "type": "game_start",
-            "message": "双方已就位，游戏开始！黑方先手。",
-        })
+        self._fanout(_STATIC["game_start"])
 
     def get_online_count(self):
         return {"players": len(self.players), "spectators": len(self.spectators)}
 
+    def mark_presence_dirty(self):
+        """有人进出或改名：0.2 秒内的多次变化合并成一条 presence 广播"""
+        if self._presence_flush is None:
+            self._presence_flush = asyncio.get_running_loop().call_later(0.2, self._flush_presence)
+
+    def _flush_presence(self):
+        """在线人数、玩家/观众名单和积分榜放在同一条消息里下发"""
+        self._presence_flush = None
+        if not self.queues:
+            return
+        pi, si = self._roster()
+        head = _encode({"type": "presence", "online": self.get_online_count(),
+                        "players": pi, "spectators": si})
+        self._fanout(head[:-1] + b',"scores":' + self._scores_list_json() + b"}")
+
 
 manager = ConnectionManager()
 
@@ -676,6 +961,78 @@ manager = ConnectionManager()
 # WebSocket
 # ============================================================
 
+def _is_admin(password):
+    """常量时间比较管理员密码（转成 bytes，非 ASCII 输入也不会报错）"""
+    return hmac.compare_digest(str(password).encode(), ADMIN_PASSWORD.encode())
+
+
+def _field(data, key, kind):
+    """取出必填字段并检查类型（True/False 不算 int）；缺字段或类型不对时抛异常"""
+    value = data[key]
+    if type(value) is not kind:
+        raise TypeError(key)
+    return value
+
+
+def _no_args(data):
+    return ()
+
+
+# 玩家指令：消息类型 -> (处理方法(websocket, *参数), 取参数(data))
+# 参数在调用处理方法之前全部取出并校验，处理方法拿到的一定是合法类型
+HANDLERS = {
+    "set_username": (manager.handle_set_username, lambda d: (_field(d, "username", str),)),
+    "move": (manager.handle_move, lambda d: (_field(d, "row", int), _field(d, "col", int))),
+    "reset": (manager.handle_reset, _no_args),
+    "resign": (manager.handle_resign, _no_args),
+    "undo_request": (manager.handle_undo_request, _no_args),
+    "undo_response": (manager.handle_undo_response, lambda d: (bool(d.get("accepted", False)),)),
+    "pause": (manager.handle_pause, _no_args),
+    "unpause": (manager.handle_unpause, _no_args),
+}
+
+# 管理员指令：消息类型 -> (处理方法, ((字段名, 默认值, 最小值, 最大值), ...))
+# 字段统一按整数解析，超出范围的整条指令作废（过大的整数 orjson 也编码不了）
+_MAX_SECONDS = 24 * 3600
+ADMIN_HANDLERS = {
+    "admin_swap_colors": (manager.admin_swap_colors, ()),
+    "admin_undo": (manager.admin_undo, ()),
+    "admin_change_capacity": (manager.admin_change_capacity, (("capacity", 3, 0, 1000),)),
+    "admin_change_timer": (manager.admin_change_timer, (("seconds", 20, 0, _MAX_SECONDS),)),
+    "admin_change_total_time": (manager.admin_change_total_time,
+                                (("seconds", 300, 0, _MAX_SECONDS),)),
+    "admin_change_pause_duration": (manager.admin_change_pause_duration,
+                                    (("seconds", 300, 0, _MAX_SECONDS),)),
+    "admin_clear_scores": (manager.admin_clear_scores, ()),
+    "admin_swap_spectator": (manager.admin_swap_spectator_player,
+                             (("spectator_index", 0, 0, 1000), ("player_color", 1, 1, 2))),
+}
+
+
+def _bounded_int(value, lo, hi):
+    n = int(value)
+    if not lo <= n <= hi:
+        raise ValueError(value)
+    return n
+
+
+def admin_required(handler, params):
+    """把管理员方法包成 HANDLERS 的形式：按整数取字段，执行前先验密码"""
+    async def run(ws, password, *args):
+        if not _is_admin(password):
+            manager._push(ws, _STATIC["err_admin_password"])
+            return
+        await handler(*args)
+
+    def parse(data):
+        return (data.get("password"),
+                *(_bounded_int(data.get(k, d), lo, hi) for k, d, lo, hi in params))
+    return run, parse
+
+
+HANDLERS.update({t: admin_required(h, p) for t, (h, p) in ADMIN_HANDLERS.items()})
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     role_info = await manager.connect(websocket)
@@ -685,100 +1042,48 @@ async def websocket_endpoint(websocket: WebSocket):
         return
 
     try:
-        await websocket.send_json({"type": "role_assigned", **role_info})
-        state = manager.game.get_state()
-        await websocket.send_json({"type": "sync_state", **state})
-        await websocket.send_json({"type": "online_count", **manager.get_online_count()})
-
-        ss = sorted(manager.scoreboard.items(), key=lambda x: -x[1])
-        await websocket.send_json({"type": "scoreboard", "scores": ss})
-        await websocket.send_json({
-            "type": "room_info",
-            "max_capacity": manager.max_capacity,
-            "current_count": manager._get_total_count(),
-        })
-        await websocket.send_json({
-            "type": "timer_setting",
-            "turn_time_limit": manager.turn_time_limit,
-            "total_time_setting": manager.total_time_setting,
-        })
-        # 发送当前计时状态
-        await websocket.send_json({
-            "type": "timer_sync",
-            "turn_remaining": manager.turn_remaining if manager.turn_time_limit > 0 else -1,
-            "turn_total": manager.turn_time_limit,
-            "total_time": {str(k): v for k, v in manager.total_time.items()},
-            "total_time_setting": manager.total_time_setting,
-            "current_turn": manager.game.current_turn,
-            "paused": manager.paused,
-            "pause_by": manager.pause_by,
-            "pause_remaining": manager.pause_remaining,
-            "pause_counts": {str(k): v for k, v in manager.pause_counts.items()},
-        })
+        # 断线重连的客户端带上 epoch/since，棋局没被重置或悔棋时只补发缺少的棋步
+        try:
+            epoch = int(websocket.query_params.get("epoch", 0))
+            since = int(websocket.query_params.get("since", 0))
+        except ValueError:
+            epoch = since = 0
+        manager.send_init(websocket, role_info, epoch, since)
 
         while True:
-            data = await websocket.receive_json()
-            t = data.get("type")
-
-            if t == "set_username":
-                manager.set_username(websocket, data["username"])
-                await manager.broadcast({"type": "online_count", **manager.get_online_count()})
-                await manager.broadcast_player_info()
-                await manager.broadcast_scoreboard()
-                if (manager.game.game_started and manager.game.winner == 0
-                        and len(manager.game.move_history) == 0
-                        and len(manager.players) == 2
-                        and not manager.paused):
-                    await manager.start_timer()
-
-            elif t == "move":
-                await manager.handle_move(websocket, data["row"], data["col"])
-            elif t == "reset":
-                await manager.handle_reset(websocket)
-            elif t == "resign":
-                await manager.handle_resign(websocket)
-            elif t == "undo_request":
-                await manager.handle_undo_request(websocket)
-            elif t == "undo_response":
-                await manager.handle_undo_response(websocket, data.get("accepted", False))
-            elif t == "pause":
-                await manager.handle_pause(websocket)
-            elif t == "unpause":
-                await manager.handle_unpause(websocket)
-
-            # 管理员
-            elif t == "admin_swap_colors":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_swap_colors()
-            elif t == "admin_undo":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_undo()
-            elif t == "admin_change_capacity":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_change_capacity(int(data.get("capacity", 3)))
-            elif t == "admin_change_timer":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_change_timer(int(data.get("seconds", 20)))
-            elif t == "admin_change_total_time":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_change_total_time(int(data.get("seconds", 300)))
-            elif t == "admin_change_pause_duration":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_change_pause_duration(int(data.get("seconds", 300)))
-            elif t == "admin_clear_scores":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_clear_scores()
-            elif t == "admin_swap_spectator":
-                if data.get("password") == ADMIN_PASSWORD:
-                    await manager.admin_swap_spectator_player(
-                        int(data.get("spectator_index", 0)),
-                        int(data.get("player_color", 1)),
-                    )
-
-    except WebSocketDisconnect:
+            # 直接用 receive()：文本帧、二进制帧都接受，断开时正常退出循环
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            raw = message.get("text")
+            try:
+                data = orjson.loads(raw if raw is not None else message.get("bytes"))
+                t = data.get("type")
+            except (orjson.JSONDecodeError, AttributeError):
+                # 不是 JSON 对象：回一条错误，连接继续
+                manager._push(websocket, _STATIC["err_bad_message"])
+                continue
+
+            if not isinstance(t, str):
+                # type 缺失或不是字符串（列表、对象不能当字典键查）
+                manager._push(websocket, _STATIC["err_bad_message"])
+                continue
+            entry = HANDLERS.get(t)
+            if entry is None:
+                continue
+            handler, parse = entry
+            try:
+                args = parse(data)
+            except (KeyError, TypeError, ValueError, OverflowError):
+                # 缺字段或字段类型不对：不进入处理方法，状态不会被改一半
+                manager._push(websocket, _STATIC["err_bad_message"])
+                continue
+            await handler(websocket, *args)
+
+    finally:
+        # 服务端主动关闭（卡死/积压被踢）后再收消息会抛 RuntimeError，同样要清理
         await manager.disconnect(websocket)
-        await manager.broadcast({"type": "online_count", **manager.get_online_count()})
-        await manager.broadcast_player_info()
+        manager.mark_presence_dirty()
 
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -793,4 +1098,9 @@ if __name__ == "__main__":
     import uvicorn
     print("🎮 五子棋服务器启动中...")
     print("🌐 打开浏览器访问: http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # loop/http 为 auto 时，装了 uvloop、httptools 就会自动启用（见 requirements.txt）
+    # 棋局状态全在本进程内存中，只能单 worker 运行
+    # permessage-deflate 是 uvicorn 的默认值，这里显式写出：整盘棋局这种大量重复的 JSON 压缩后小很多
+    uvicorn.run(app, host="0.0.0.0", port=8000,
+                loop="auto", http="auto", ws="websockets", workers=1,
+                ws_per_message_deflate=True)